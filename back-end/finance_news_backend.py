@@ -16,20 +16,42 @@ FinanceFlow Web App (Production Ready)
 import os
 import re
 from datetime import datetime
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple, Iterator
 import yfinance as yf
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import httpx
 from dataclasses import dataclass, asdict
+from functools import lru_cache
 import math  # Added for pagination calculation
+import threading
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from cachetools import TTLCache, LRUCache
 
 from groq import Groq
-from flask import Flask, request, jsonify, render_template
+try:
+    from fastembed import TextEmbedding
+except ImportError:  # The semantic Q&A cache is optional; exact-match caching still works without it
+    TextEmbedding = None  # Installed via requirements-semantic.txt
+try:
+    from numba import njit
+except ImportError:  # Similarity search falls back to a NumPy matrix-vector product
+    njit = None  # Installed via requirements-semantic.txt
+from flask import Flask, Response, request, jsonify, render_template, make_response
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
+from flask_compress import Compress
 import logging
 from dotenv import load_dotenv
 
 import firebase_admin
 from firebase_admin import credentials, firestore
 import json
+import orjson
 
 # --- Initialization ---
 load_dotenv()
@@ -37,40 +59,55 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 logger = logging.getLogger(__name__)
 
 # --- Firebase Initialization ---
-db_firestore = None
-analyzed_news_collection = None
-daily_briefs_collection = None
-metadata_collection = None
+# Deferred to first use so importing the app (and booting workers) never waits on Firebase
+_firebase_lock = threading.Lock()
+_db = None
 
-try:
-    firebase_credentials_json = os.getenv("FIREBASE_CREDENTIALS_JSON")
-    if firebase_credentials_json:
-        logger.info("WEB APP: Found FIREBASE_CREDENTIALS_JSON environment variable. Attempting to use it.")
-        cred = credentials.Certificate(json.loads(firebase_credentials_json))
-    else:
-        key_path = "firebase-key.json"
-        if os.path.exists(key_path):
-            logger.info(f"WEB APP: Found Firebase key file at {key_path}. Attempting to use it.")
-            cred = credentials.Certificate(key_path)
-        else:
-            raise FileNotFoundError(f"Firebase credentials not found. Neither FIREBASE_CREDENTIALS_JSON env var nor file at {key_path} exists.")
-    
-    firebase_admin.initialize_app(cred)
-    db_firestore = firestore.client()
-
-    # Define all collection references
-    analyzed_news_collection = db_firestore.collection('analyzed_news')
-    daily_briefs_collection = db_firestore.collection('daily_briefs')
-    # This collection is crucial for efficient pagination counting
-    metadata_collection = db_firestore.collection('collections_metadata')
-    
-    logger.info("WEB APP: Firebase initialized successfully.")
-except Exception as e:
-    logger.error(f"WEB APP: Failed to initialize Firebase: {e}", exc_info=True)
-    # Ensure all clients are None on failure
-    analyzed_news_collection = None
-    daily_briefs_collection = None
-    metadata_collection = None
+def get_db():
+    """
+    Initializes Firebase on first use and returns the Firestore client, or None if it cannot be set up.
+    Only a successful client is memoized, so a transient failure is retried on the next request.
+    """
+    global _db
+    if _db is not None: return _db
+    with _firebase_lock:
+        if _db is not None: return _db
+        try:
+            if not firebase_admin._apps:
+                firebase_credentials_json = os.getenv("FIREBASE_CREDENTIALS_JSON")
+                if firebase_credentials_json:
+                    logger.info("WEB APP: Found FIREBASE_CREDENTIALS_JSON environment variable. Attempting to use it.")
+                    cred = credentials.Certificate(json.loads(firebase_credentials_json))
+                else:
+                    key_path = "firebase-key.json"
+                    if os.path.exists(key_path):
+                        logger.info(f"WEB APP: Found Firebase key file at {key_path}. Attempting to use it.")
+                        cred = credentials.Certificate(key_path)
+                    else:
+                        raise FileNotFoundError(f"Firebase credentials not found. Neither FIREBASE_CREDENTIALS_JSON env var nor file at {key_path} exists.")
+
+                firebase_admin.initialize_app(cred)
+            _db = firestore.client()
+            logger.info("WEB APP: Firebase initialized successfully.")
+        except Exception as e:
+            logger.error(f"WEB APP: Failed to initialize Firebase: {e}", exc_info=True)
+        return _db
+
+def get_collection(name: str):
+    """Returns a Firestore collection reference, or None when the database is unavailable."""
+    db = get_db()
+    return db.collection(name) if db else None
+
+ANALYZED_NEWS = 'analyzed_news'
+DAILY_BRIEFS = 'daily_briefs'
+
+
+# --- Shared HTTP Clients ---
+# Process-wide keep-alive pools so outbound calls to Yahoo and Groq reuse TLS connections
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=64,
+                                           max_retries=Retry(total=2, backoff_factor=0.2)))
+GROQ_HTTP_CLIENT = httpx.Client(limits=httpx.Limits(max_connections=32, max_keepalive_connections=16))
 
 
 # --- Data Classes ---
@@ -81,91 +118,445 @@ class StockData:
     change: float
     percent_change: float
 
-@dataclass
-class NewsItem:
-    # This is used for context in the Q&A function
-    id: str
-    title: str
-    link: str
-    source: str
-    published: Any
-    content: str = ""
-    analysis: Optional[Dict[str, Any]] = None
-    processed_at: Any = None
-
 # --- Utility Functions ---
+# Bounded quantifier covers the length and no-space checks in a single compiled match
+_TICKER_RE = re.compile(r'[A-Z0-9.\-]{1,6}')
+
 def is_valid_ticker(symbol: str) -> bool:
     """A simple validator to filter out invalid ticker symbols returned by the AI."""
-    if not symbol or not isinstance(symbol, str): return False
-    if len(symbol) > 6 or len(symbol) < 1: return False
-    if ' ' in symbol: return False
-    if not re.match(r'^[A-Z0-9.-]+$', symbol): return False
-    return True
+    return isinstance(symbol, str) and bool(_TICKER_RE.fullmatch(symbol))
+
+def make_etag(*parts: Any) -> str:
+    """Builds a short, stable ETag from document ids, update times and any other version markers."""
+    return hashlib.blake2b("|".join(str(p) for p in parts).encode(), digest_size=16).hexdigest()
+
+# Indexed by dt.month, so slot 0 is unused
+_THAI_MONTHS = (
+    None, "ม.ค.", "ก.พ.", "มี.ค.", "เม.ย.", "พ.ค.", "มิ.ย.",
+    "ก.ค.", "ส.ค.", "ก.ย.", "ต.ค.", "พ.ย.", "ธ.ค."
+)
 
 def format_datetime_to_thai(dt: datetime) -> str:
     """Formats a datetime object to 'DD Mon YYYY, HH:MM' with Thai month abbreviation."""
-    thai_months = {
-        1: "ม.ค.", 2: "ก.พ.", 3: "มี.ค.", 4: "เม.ย.", 5: "พ.ค.", 6: "มิ.ย.",
-        7: "ก.ค.", 8: "ส.ค.", 9: "ก.ย.", 10: "ต.ค.", 11: "พ.ย.", 12: "ธ.ค."
-    }
-    return f"{dt.day} {thai_months[dt.month]} {dt.year}, {dt.hour:02d}:{dt.minute:02d}"
+    return f"{dt.day} {_THAI_MONTHS[dt.month]} {dt.year}, {dt.hour:02d}:{dt.minute:02d}"
+
+@lru_cache(maxsize=512)
+def parse_iso_datetime(value: str) -> datetime:
+    """Parses an ISO-8601 string (accepting a trailing 'Z'); memoized since feed timestamps recur across requests."""
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+_SENTIMENT_TO_IMPACT = {'Positive': 'Bullish', 'Negative': 'Bearish'}
+
+def render_news_item(item: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Shapes a raw analyzed_news document into what the frontend renders.
+    Ingestion is expected to store these derived fields (analysis.impact, summaries, uppercased
+    affected_symbols and 'published_thai') up front; such documents pass straight through, and
+    this fallback only runs for documents written before that.
+    """
+    analysis = item.get('analysis')
+    if ('published_thai' in item and isinstance(analysis, dict) and 'impact' in analysis
+            and isinstance(analysis.get('affected_symbols'), list)):
+        item['published'] = item.pop('published_thai')
+        return item
+
+    if not isinstance(analysis, dict): analysis = item['analysis'] = {}
+    analysis['impact'] = _SENTIMENT_TO_IMPACT.get(analysis.get('sentiment', 'Neutral'), 'Mixed')
+    analysis['impact_score'] = analysis.get('impact_score', None)
+    analysis['summary_en'] = analysis.get('summary_en', item['content_preview'][:150] + '...' if item.get('content_preview') else 'No summary available.')
+    analysis['summary_th'] = analysis.get('summary_th', analysis['summary_en'])
+
+    affected_symbols = analysis.get('affected_symbols', [])
+    if not isinstance(affected_symbols, list): affected_symbols = []
+    analysis['affected_symbols'] = list(dict.fromkeys(sym.upper() for sym in affected_symbols if isinstance(sym, str)))
+
+    published = item.pop('published_thai', None) or item.get('published')
+    if isinstance(published, datetime): item['published'] = format_datetime_to_thai(published)
+    elif isinstance(published, str):
+        try: item['published'] = format_datetime_to_thai(parse_iso_datetime(published))
+        except ValueError: item['published'] = published
+    return item
+
+def _best_match_numpy(emb: np.ndarray, bank: np.ndarray, mask: np.ndarray) -> Tuple[int, float]:
+    scores = np.where(mask, bank @ emb, -1.0)
+    idx = int(np.argmax(scores)) if len(scores) else -1
+    return (idx, float(scores[idx])) if idx >= 0 and mask[idx] else (-1, -1.0)
+
+# Only the semantic Q&A cache searches embeddings, so the kernel is compiled only when it can run.
+# It is single-threaded on purpose: a threaded parallel region warmed in the preloaded master is not
+# fork-safe (OpenMP aborts in the children), and at 512x384 it is no faster than one pass.
+if njit is not None and TextEmbedding is not None:
+    @njit(cache=True, fastmath=True)
+    def _best_match_jit(emb, bank, mask):
+        n, dim = bank.shape
+        idx, best = -1, -1.0
+        for i in range(n):
+            if mask[i]:
+                s = np.float32(0.0)
+                for j in range(dim):
+                    s += emb[j] * bank[i, j]
+                if s > best:
+                    best = s
+                    idx = i
+        return idx, best
+
+    def best_match(emb: np.ndarray, bank: np.ndarray, mask: np.ndarray) -> Tuple[int, float]:
+        """Returns (row, cosine score) of the most similar masked row of an L2-normalized bank, or (-1, -1.0)."""
+        idx, best = _best_match_jit(emb, bank, mask)
+        return int(idx), float(best)
+
+    # Compile (or load from the on-disk cache) at import so the first /api/ask doesn't pay for it
+    best_match(np.zeros(1, dtype=np.float32), np.zeros((1, 1), dtype=np.float32), np.zeros(1, dtype=np.bool_))
+else:
+    best_match = _best_match_numpy
 
 # --- Service Classes ---
 class MarketDataProvider:
     """Fetches live stock market data."""
-    def get_stock_data(self, symbols: List[str]) -> Dict[str, StockData]:
-        if not symbols: return {}
+    SPARK_URL = "https://query1.finance.yahoo.com/v8/finance/spark"
+    SPARK_BATCH_SIZE = 20  # The spark endpoint accepts at most 20 symbols per request
+    QUOTE_TTL = 30  # seconds a quote is reused before refetching
+
+    def __init__(self, session: requests.Session = HTTP_SESSION):
+        self.session = session
+        # Quotes are shared across news items and pages, so keep them briefly per symbol
+        self._quote_cache = TTLCache(maxsize=512, ttl=self.QUOTE_TTL)
+        self._quote_lock = threading.Lock()
+
+    @staticmethod
+    def _build_stock_data(symbol: str, price: Optional[float], prev_close: Optional[float]) -> Optional[StockData]:
+        if not price or not prev_close: return None
+        return StockData(
+            symbol=symbol,
+            price=round(price, 2),
+            change=round(price - prev_close, 2),
+            percent_change=round(((price - prev_close) / prev_close) * 100, 2)
+        )
+
+    def _fetch_spark(self, symbols: List[str]) -> Dict[str, StockData]:
+        """Fetches quotes for up to SPARK_BATCH_SIZE symbols in a single HTTP request."""
+        response = self.session.get(
+            self.SPARK_URL,
+            params={"symbols": ",".join(symbols), "range": "1d", "interval": "5m"},
+            headers={"User-Agent": "Mozilla/5.0"},
+            timeout=10,
+        )
+        response.raise_for_status()
+        return self._parse_spark(response.json())
+
+    def _parse_spark(self, payload: Dict[str, Any]) -> Dict[str, StockData]:
+        """
+        Parses a v8 spark payload, a flat object keyed by symbol:
+        {"AAPL": {"symbol": "AAPL", "close": [...], "previousClose": ..., "chartPreviousClose": ...}}
+        """
+        data = {}
+        for symbol, series in payload.items():
+            try:
+                closes = series.get('close') or []
+                price = next((c for c in reversed(closes) if c is not None), None)
+                # previousClose is often present but null, so fall through to the chart's value
+                prev_close = series.get('previousClose') or series.get('chartPreviousClose')
+                stock = self._build_stock_data(symbol, price, prev_close)
+                if stock: data[symbol] = stock
+            except (AttributeError, TypeError) as e:
+                logger.warning(f"WEB APP: Could not parse spark data for ticker '{symbol}': {e}")
+        return data
+
+    def _fetch_yfinance(self, symbols: List[str]) -> Dict[str, StockData]:
+        """Per-ticker fallback for symbols the spark endpoint did not return."""
         data = {}
-        logger.info(f"WEB APP: Fetching stock data for: {symbols}")
         try:
-            tickers = yf.Tickers(' '.join(symbols))
+            tickers = yf.Tickers(' '.join(symbols), session=self.session)
             for symbol in symbols:
                 try:
                     info = tickers.tickers[symbol].fast_info
-                    price, prev_close = info.get('last_price'), info.get('previous_close')
-                    if price and prev_close:
-                        data[symbol] = StockData(
-                            symbol=symbol,
-                            price=round(price, 2),
-                            change=round(price - prev_close, 2),
-                            percent_change=round(((price - prev_close) / prev_close) * 100, 2)
-                        )
+                    stock = self._build_stock_data(symbol, info.get('last_price'), info.get('previous_close'))
+                    if stock: data[symbol] = stock
                 except Exception as e:
                     logger.warning(f"WEB APP: Could not fetch data for an individual ticker '{symbol}': {e}")
         except Exception as e:
             logger.error(f"WEB APP: A general error occurred in yfinance Tickers call: {e}")
         return data
 
+    def get_stock_data(self, symbols: List[str]) -> Dict[str, StockData]:
+        if not symbols: return {}
+        data = {}
+        with self._quote_lock:
+            for symbol in symbols:
+                cached = self._quote_cache.get(symbol)
+                if cached is not None: data[symbol] = cached
+        missing = [symbol for symbol in symbols if symbol not in data]
+        if not missing: return data
+
+        logger.info(f"WEB APP: Fetching stock data for: {missing}")
+        fetched = {}
+        for i in range(0, len(missing), self.SPARK_BATCH_SIZE):
+            batch = missing[i:i + self.SPARK_BATCH_SIZE]
+            try:
+                fetched.update(self._fetch_spark(batch))
+            except Exception as e:
+                logger.error(f"WEB APP: Spark quote request failed for {batch}: {e}")
+        leftover = [symbol for symbol in missing if symbol not in fetched]
+        if leftover:
+            fetched.update(self._fetch_yfinance(leftover))
+
+        with self._quote_lock:
+            self._quote_cache.update(fetched)
+        data.update(fetched)
+        return data
+
+class LatestNewsCache:
+    """Shares the latest analyzed news snapshots between /api/ask and /api/main_feed for a short TTL."""
+    SIZE = 50
+    TTL = 45  # seconds
+
+    def __init__(self, collection_name: str):
+        self._collection_name = collection_name
+        self._docs = []
+        self._ts: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def get(self, n: int = SIZE, ttl: float = TTL) -> list:
+        """Returns the newest n document snapshots, re-streaming from Firestore only once the TTL lapses."""
+        with self._lock:
+            now = time.monotonic()
+            if self._ts is None or now - self._ts >= ttl:
+                query = (get_collection(self._collection_name)
+                         .select(FEED_FIELDS)
+                         .order_by("published", direction=firestore.Query.DESCENDING)
+                         .order_by("__name__", direction=firestore.Query.DESCENDING)
+                         .limit(self.SIZE))
+                self._docs = list(query.stream())
+                self._ts = now
+            return self._docs[:n]
+
+class AnswerCache:
+    """Memoizes Q&A answers per news context: exact matches first, then near-duplicate questions by embedding."""
+    EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+    EMBEDDING_DIM = 384
+    SEMANTIC_SIZE = 512
+    SIMILARITY_THRESHOLD = 0.95
+
+    def __init__(self):
+        self._exact = TTLCache(maxsize=2048, ttl=3600)
+        # Ring buffer of the last SEMANTIC_SIZE answers; embeddings live in one contiguous float32 bank
+        self._bank = np.zeros((self.SEMANTIC_SIZE, self.EMBEDDING_DIM), dtype=np.float32)
+        self._answers: List[Optional[str]] = [None] * self.SEMANTIC_SIZE
+        self._contexts: List[Optional[str]] = [None] * self.SEMANTIC_SIZE
+        self._next_slot = 0
+        self._lock = threading.Lock()
+        # Loaded in the background so no request waits on the model; until then only exact matches hit
+        self._embedder = None
+        if TextEmbedding is not None:
+            threading.Thread(target=self._load_embedder, name="qa-embedder", daemon=True).start()
+
+    def _load_embedder(self):
+        """Loads the embedding model, from FASTEMBED_CACHE_DIR when it has been pre-downloaded there."""
+        try:
+            self._embedder = TextEmbedding(model_name=self.EMBEDDING_MODEL, cache_dir=os.getenv("FASTEMBED_CACHE_DIR"))
+            logger.info("WEB APP: Semantic Q&A cache enabled.")
+        except Exception as e:
+            logger.warning(f"WEB APP: Semantic Q&A cache disabled, could not load embedding model: {e}")
+
+    @staticmethod
+    def context_hash(doc_ids: List[str]) -> str:
+        return hashlib.blake2b("|".join(doc_ids).encode(), digest_size=16).hexdigest()
+
+    @staticmethod
+    def _exact_key(question: str, context_hash: str) -> str:
+        return hashlib.blake2b((question.strip().lower() + context_hash).encode(), digest_size=16).hexdigest()
+
+    def _embed(self, question: str) -> Optional[np.ndarray]:
+        if self._embedder is None: return None
+        try:
+            embedding = np.asarray(next(iter(self._embedder.embed([question.strip().lower()]))), dtype=np.float32)
+        except Exception as e:
+            logger.warning(f"WEB APP: Could not embed question for the semantic cache: {e}")
+            return None
+        if embedding.shape != (self.EMBEDDING_DIM,): return None
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm else None
+
+    def get(self, question: str, context_hash: str) -> Tuple[Optional[str], Optional[np.ndarray]]:
+        """Returns (answer or None, embedding) so a miss can be stored without embedding twice."""
+        key = self._exact_key(question, context_hash)
+        with self._lock:
+            answer = self._exact.get(key)
+        if answer is not None: return answer, None
+
+        embedding = self._embed(question)
+        if embedding is None: return None, None
+        with self._lock:
+            mask = np.fromiter((ctx == context_hash for ctx in self._contexts), dtype=np.bool_, count=self.SEMANTIC_SIZE)
+            if not mask.any(): return None, embedding
+            idx, score = best_match(embedding, self._bank, mask)
+            if idx < 0 or score < self.SIMILARITY_THRESHOLD: return None, embedding
+            answer = self._answers[idx]
+            self._exact[key] = answer
+        return answer, embedding
+
+    def put(self, question: str, context_hash: str, answer: str, embedding: Optional[np.ndarray] = None):
+        with self._lock:
+            self._exact[self._exact_key(question, context_hash)] = answer
+            if embedding is not None:
+                slot = self._next_slot
+                self._bank[slot] = embedding
+                self._answers[slot] = answer
+                self._contexts[slot] = context_hash
+                self._next_slot = (slot + 1) % self.SEMANTIC_SIZE
+
+# Fixed parts of the Q&A prompt; only the context block and question vary per request
+_PROMPT_HEAD = (
+    "You are a helpful AI investment assistant. Answer the user's question in Thai based *only* on the provided context. "
+    "Do not give direct financial advice. If the context is insufficient, state that.\n"
+    "CONTEXT:\n---\n"
+)
+_PROMPT_TAIL = '\n---\nUSER QUESTION: "{question}"\n\nYOUR ANSWER (in Thai):'
+
 class AIProcessor:
     """This version of the processor is only for the Q&A feature."""
+    OFFLINE_MESSAGE = "AI processor is offline."
+    ERROR_MESSAGE = "ขออภัยค่ะ เกิดข้อผิดพลาดในการประมวลผลคำตอบ"
+
     def __init__(self):
         self.api_key = os.getenv("GROQ_API_KEY")
-        self.client = Groq(api_key=self.api_key) if self.api_key else None
+        self.client = Groq(api_key=self.api_key, http_client=GROQ_HTTP_CLIENT) if self.api_key else None
         if not self.client: logger.warning("WEB APP: GROQ_API_KEY not found for Q&A.")
         self.model = "llama3-8b-8192"
 
-    def answer_user_question(self, question: str, news_context: List[NewsItem]) -> str:
-        if not self.client: return "AI processor is offline."
-        context_str = "\n\n".join([f"Title: {item.title}\nSummary: {item.analysis.get('summary_en', '')}" for item in news_context if item.analysis])
-        prompt = f"""You are a helpful AI investment assistant. Answer the user's question in Thai based *only* on the provided context. Do not give direct financial advice. If the context is insufficient, state that.
-        CONTEXT:\n---\n{context_str}\n---\nUSER QUESTION: "{question}"\n\nYOUR ANSWER (in Thai):"""
+    @staticmethod
+    def _build_prompt(question: str, news_context: List[Dict[str, Any]]) -> str:
+        context_str = "\n\n".join([f"Title: {item.get('title', '')}\nSummary: {item['analysis'].get('summary_en', '')}" for item in news_context if item.get('analysis')])
+        return _PROMPT_HEAD + context_str + _PROMPT_TAIL.format(question=question)
+
+    def answer_user_question(self, question: str, news_context: List[Dict[str, Any]]) -> str:
+        if not self.client: return self.OFFLINE_MESSAGE
         try:
             chat_completion = self.client.chat.completions.create(
-                messages=[{"role": "user", "content": prompt}], model=self.model, temperature=0.5
+                messages=[{"role": "user", "content": self._build_prompt(question, news_context)}], model=self.model, temperature=0.5
             )
             return chat_completion.choices[0].message.content
         except Exception as e:
             logger.error(f"WEB APP: Groq Q&A failed: {e}")
-            return "ขออภัยค่ะ เกิดข้อผิดพลาดในการประมวลผลคำตอบ"
+            return self.ERROR_MESSAGE
+
+    def stream_user_answer(self, question: str, news_context: List[Dict[str, Any]]) -> Iterator[str]:
+        """Yields the answer as Groq produces it, so clients can render from the first token."""
+        if not self.client:
+            yield self.OFFLINE_MESSAGE
+            return
+        try:
+            stream = self.client.chat.completions.create(
+                messages=[{"role": "user", "content": self._build_prompt(question, news_context)}], model=self.model, temperature=0.5, stream=True
+            )
+            for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta: yield delta
+        except Exception as e:
+            logger.error(f"WEB APP: Groq Q&A stream failed: {e}")
+            yield self.ERROR_MESSAGE
 
 # --- Application Components ---
-market_provider = MarketDataProvider()
-ai_processor_for_qa = AIProcessor()
+def lazy_singleton(factory):
+    """Wraps a zero-argument factory so it runs once, on first call, even under concurrent requests."""
+    instance = None
+    lock = threading.Lock()
+    def get():
+        nonlocal instance
+        if instance is None:
+            with lock:
+                if instance is None:
+                    instance = factory()
+        return instance
+    return get
+
+# Built on first use so workers that never quote or answer skip yfinance/Groq/embedding setup
+get_market_provider = lazy_singleton(MarketDataProvider)
+get_ai_processor = lazy_singleton(AIProcessor)
+get_answer_cache = lazy_singleton(AnswerCache)
+latest_news = LatestNewsCache(ANALYZED_NEWS)
+
+# Fields rendered by the feed. Ingestion writes 'content_preview' (the first 200 characters
+# of 'content') so the article body never has to be read here.
+FEED_FIELDS = ['id', 'title', 'link', 'source', 'published', 'published_thai', 'analysis', 'content_preview']
+
+# Browser/CDN freshness (seconds): briefs change twice a day, the feed on the ingestion cadence
+BRIEF_MAX_AGE = 300
+FEED_MAX_AGE = 45
+
+# Upper bound on distinct tickers quoted per feed page
+MAX_QUOTED_SYMBOLS = 20
+
+# --- Response Caches ---
+# analyzed_news only changes when the backend ingests a new batch, so a short TTL
+# lets repeated feed hits skip Firestore and yfinance entirely.
+# Entries are keyed by quote bucket and expire with it, so a cached page (and its ETag) never
+# outlives the stock prices it carries.
+_feed_cache = TTLCache(maxsize=64, ttl=MarketDataProvider.QUOTE_TTL)
+_feed_lock = threading.Lock()
+# Symbols last shown on each (page, limit), used to warm the quote cache while the snapshot loads
+_page_symbols = LRUCache(maxsize=256)
+
+# Background pool for overlapping independent network I/O within a request
+_io_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="feed-io")
+
+# The server SDK has no cache-first read path, so briefs are memoized per document
+# version and both read endpoints answer If-None-Match with a 304.
+_brief_cache: Dict[str, Dict[str, Any]] = {}
+_brief_lock = threading.Lock()
 
 # --- Flask App & API Endpoints ---
+def _orjson_default(obj: Any) -> Any:
+    """Covers types orjson does not serialize natively, e.g. Firestore's DatetimeWithNanoseconds subclass."""
+    if isinstance(obj, datetime): return obj.isoformat()
+    if isinstance(obj, (set, frozenset)): return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+class ORJSONProvider(JSONProvider):
+    """Serializes Flask JSON responses with orjson instead of the stdlib json module."""
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return orjson.dumps(obj, default=_orjson_default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY).decode()
+
+    def loads(self, s: Any, **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
 app = Flask(__name__, template_folder='../front-end/dist', static_folder='../front-end/dist/assets')
+app.json = ORJSONProvider(app)
+# Brotli first with a gzip fallback; tiny payloads aren't worth the CPU
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+app.config['COMPRESS_LEVEL'] = 4
+app.config['COMPRESS_MIN_SIZE'] = 1024
+Compress(app)
 CORS(app)
 
+def with_cache(response: Response, max_age: int) -> Response:
+    """Marks a response as publicly cacheable by browsers and CDNs, allowing stale reuse while revalidating."""
+    response.headers['Cache-Control'] = f'public, max-age={max_age}, stale-while-revalidate={max_age * 2}'
+    response.vary.add('Accept-Encoding')
+    return response
+
+def client_has_etag(etag: str) -> bool:
+    """True if If-None-Match carries this ETag, bare or with the ':<algorithm>' suffix Flask-Compress appends."""
+    return any(tag in request.if_none_match
+               for tag in (etag, *(f"{etag}:{algorithm}" for algorithm in app.config['COMPRESS_ALGORITHM'])))
+
+def success_response(data: Dict[str, Any], etag: str, max_age: int):
+    """Returns a 304 when the client already holds this version, otherwise the JSON payload with its ETag."""
+    if client_has_etag(etag):
+        response = make_response("", 304)
+    else:
+        response = make_response(jsonify({"status": "success", "data": data}))
+    response.set_etag(etag)
+    return with_cache(response, max_age)
+
+def sse_response(deltas: Iterator[str]) -> Response:
+    """Wraps answer chunks as Server-Sent Events: one JSON 'delta' per message, then a 'done' event."""
+    def generate():
+        for delta in deltas:
+            yield b"data: " + orjson.dumps({"delta": delta}) + b"\n\n"
+        yield b"event: done\ndata: {}\n\n"
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -173,16 +564,27 @@ def index():
 
 @app.route('/api/daily_brief')
 def get_daily_brief():
+    daily_briefs_collection = get_collection(DAILY_BRIEFS)
     if not daily_briefs_collection:
         return jsonify({"status": "error", "message": "Database connection not available."}), 500
     try:
         query = daily_briefs_collection.order_by("__name__", direction=firestore.Query.DESCENDING).limit(1)
         docs = list(query.stream())
         if docs:
-            brief_data = docs[0].to_dict()
-            if 'generated_at_utc' in brief_data and isinstance(brief_data['generated_at_utc'], datetime):
-                brief_data['generated_at_utc'] = brief_data['generated_at_utc'].isoformat()
-            return jsonify({"status": "success", "data": brief_data})
+            doc = docs[0]
+            etag = make_etag(doc.id, doc.update_time)
+            with _brief_lock:
+                cached = _brief_cache.get(doc.id)
+            if cached is not None and cached['etag'] == etag:
+                return success_response(cached['data'], etag, BRIEF_MAX_AGE)
+
+            # Datetimes such as generated_at_utc are emitted as ISO strings by the JSON provider
+            brief_data = doc.to_dict()
+            with _brief_lock:
+                # Only the latest brief is ever served, so drop older versions
+                _brief_cache.clear()
+                _brief_cache[doc.id] = {"etag": etag, "data": brief_data}
+            return success_response(brief_data, etag, BRIEF_MAX_AGE)
         else:
             logger.warning("WEB APP: No daily brief document was found in the collection.")
             return jsonify({"status": "error", "message": "No daily brief is available yet."}), 404
@@ -193,21 +595,40 @@ def get_daily_brief():
 
 @app.route('/api/main_feed')
 def get_main_feed():
-    # <<< MODIFICATION: We no longer need metadata_collection for this endpoint >>>
-    if not analyzed_news_collection:
+    if not get_collection(ANALYZED_NEWS):
         return jsonify({"status": "error", "message": "Database connection not available."}), 500
     
     try:
-        # Step 1: Get pagination parameters from the request query string
-        page = int(request.args.get('page', 1))
-        limit = int(request.args.get('limit', 10))
-        
         # <<< MODIFICATION: Hardcode the total number of news to 50 >>>
-        # This ensures the app only ever considers the latest 50 articles.
-        TOTAL_NEWS_TO_SHOW = 50
+        # This ensures the app only ever considers the latest 50 articles, all held by the snapshot.
+        TOTAL_NEWS_TO_SHOW = LatestNewsCache.SIZE
+
+        # Step 1: Get pagination parameters from the request query string,
+        # clamped to page >= 1 and 1 <= limit <= TOTAL_NEWS_TO_SHOW
+        try:
+            page = max(int(request.args.get('page', 1)), 1)
+            limit = min(max(int(request.args.get('limit', 10)), 1), TOTAL_NEWS_TO_SHOW)
+        except ValueError:
+            return jsonify({"status": "error", "message": "page and limit must be integers."}), 400
+        cursor_token = request.args.get('cursor')
+
+        quote_bucket = int(time.time() // MarketDataProvider.QUOTE_TTL)
+        cache_key = (page, limit, cursor_token, quote_bucket)
+        with _feed_lock:
+            cached = _feed_cache.get(cache_key)
+        if cached is not None:
+            return success_response(cached['data'], cached['etag'], FEED_MAX_AGE)
         
+        # Step 2: Resolve where the page starts. A cursor is the id of the last document the client
+        # saw, located in the shared latest-news snapshot; ids outside it point past the 50-article
+        # window, just like a page number beyond the limit.
+        offset = (page - 1) * limit
+        if cursor_token:
+            latest_ids = [doc.id for doc in latest_news.get(LatestNewsCache.SIZE)]
+            offset = latest_ids.index(cursor_token) + 1 if cursor_token in latest_ids else TOTAL_NEWS_TO_SHOW
+
         # Prevent users from requesting pages beyond the limit
-        if (page - 1) * limit >= TOTAL_NEWS_TO_SHOW:
+        if offset >= TOTAL_NEWS_TO_SHOW:
             return jsonify({
                 "status": "success", 
                 "data": {
@@ -217,61 +638,52 @@ def get_main_feed():
                         "currentPage": page,
                         "pageSize": limit,
                         "totalNews": TOTAL_NEWS_TO_SHOW,
-                        "totalPages": math.ceil(TOTAL_NEWS_TO_SHOW / limit)
+                        "totalPages": math.ceil(TOTAL_NEWS_TO_SHOW / limit),
+                        "nextCursor": None
                     }
                 }
             }), 200
 
-        # Step 2: Build the base query (this remains the same)
-        base_query = analyzed_news_collection.order_by("published", direction=firestore.Query.DESCENDING)
-
-        # Step 3: Use a cursor for pagination (this remains the same)
-        query = base_query
-        cursor = None
-        if page > 1:
-            offset = (page - 1) * limit
-            last_doc_query = base_query.limit(offset).get()
-            if len(last_doc_query) > 0:
-                cursor = last_doc_query[-1]
-                query = base_query.start_after(cursor)
-
-        # Step 4: Execute the query for the current page, but limit the total scope.
-        # The limit() here applies to the current page's fetch, not the total.
-        docs = query.limit(limit).stream()
+        # Step 3: Slice the page from the latest-news snapshot, which holds the whole 50-article window;
+        # the last page is cut short so no request reaches past it.
+        # Quotes for the symbols this page showed last time are fetched concurrently, so a snapshot
+        # refresh costs roughly max(Firestore, yfinance) instead of their sum.
+        with _feed_lock:
+            speculative_symbols = _page_symbols.get((page, limit))
+        quote_prefetch = _io_executor.submit(get_market_provider().get_stock_data, speculative_symbols) if speculative_symbols else None
+        docs = latest_news.get(TOTAL_NEWS_TO_SHOW)[offset:offset + limit]
         news_from_db_raw = [doc.to_dict() for doc in docs]
+        # No cursor is handed out once this page reaches the end of the window
+        has_more = len(docs) == limit and offset + limit < TOTAL_NEWS_TO_SHOW
+        next_cursor = docs[-1].id if has_more else None
+        # The quote TTL bucket is part of the ETag so a 304 never outlives the stock prices it covers
+        etag = make_etag(page, limit, quote_bucket, *(f"{doc.id}@{doc.update_time}" for doc in docs))
+        if client_has_etag(etag):
+            # Client already has this page; skip processing and the yfinance round-trip
+            return success_response({}, etag, FEED_MAX_AGE)
         
-        # Step 5: Process the news items for the current page (same logic)
-        processed_news = []
-        all_raw_symbols = set()
-        for item in news_from_db_raw:
-            # ... (the existing processing logic is fine, no changes needed here) ...
-            if 'analysis' not in item or not isinstance(item['analysis'], dict): item['analysis'] = {}
-            firestore_sentiment = item['analysis'].get('sentiment', 'Neutral')
-            if firestore_sentiment == 'Positive': item['analysis']['impact'] = 'Bullish'
-            elif firestore_sentiment == 'Negative': item['analysis']['impact'] = 'Bearish'
-            else: item['analysis']['impact'] = 'Mixed'
-            
-            item['analysis']['impact_score'] = item['analysis'].get('impact_score', None)
-            item['analysis']['summary_en'] = item['analysis'].get('summary_en', item.get('content', '')[:150] + '...' if item.get('content') else 'No summary available.')
-            item['analysis']['summary_th'] = item['analysis'].get('summary_th', item['analysis']['summary_en'])
-            
-            affected_symbols = item['analysis'].get('affected_symbols', [])
-            if not isinstance(affected_symbols, list): affected_symbols = []
-            item['analysis']['affected_symbols'] = affected_symbols
-            
-            if isinstance(item.get('published'), datetime): item['published'] = format_datetime_to_thai(item['published'])
-            elif isinstance(item.get('published'), str):
-                try: dt_obj = datetime.fromisoformat(item['published'].replace('Z', '+00:00')); item['published'] = format_datetime_to_thai(dt_obj)
-                except ValueError: pass
-            
-            all_raw_symbols.update(sym.upper() for sym in item['analysis']['affected_symbols'])
-            processed_news.append(item)
-        
-        # Step 6: Get stock data for the current page's news (same logic)
-        valid_symbols = {sym for sym in all_raw_symbols if is_valid_ticker(sym)}
-        stock_data = market_provider.get_stock_data(list(valid_symbols)[:20])
+        # Step 4: Process the news items for the current page (pre-rendered documents pass through)
+        processed_news = [render_news_item(item) for item in news_from_db_raw]
+
+        # Step 5: Get stock data for the current page's news. Symbols are deduplicated and
+        # validated in one pass, keeping the first MAX_QUOTED_SYMBOLS in order of appearance.
+        seen_symbols: Dict[str, None] = {}
+        for item in processed_news:
+            for symbol in item['analysis'].get('affected_symbols') or []:
+                if is_valid_ticker(symbol) and symbol not in seen_symbols:
+                    seen_symbols[symbol] = None
+                    if len(seen_symbols) == MAX_QUOTED_SYMBOLS: break
+            if len(seen_symbols) == MAX_QUOTED_SYMBOLS: break
+        valid_symbols = list(seen_symbols)
+        with _feed_lock:
+            _page_symbols[(page, limit)] = valid_symbols
+        if quote_prefetch is not None:
+            # Let the prefetch land in the quote cache first so only new symbols are fetched below
+            try: quote_prefetch.result()
+            except Exception as e: logger.warning(f"WEB APP: Speculative quote prefetch failed: {e}")
+        stock_data = get_market_provider().get_stock_data(valid_symbols)
         
-        # Step 7: Build the response structure with the hardcoded pagination info
+        # Step 6: Build the response structure with the hardcoded pagination info
         response_data = {
             "news": processed_news,
             "stocks": {symbol: asdict(data) for symbol, data in stock_data.items()},
@@ -279,31 +691,57 @@ def get_main_feed():
                 "currentPage": page,
                 "pageSize": limit,
                 "totalNews": TOTAL_NEWS_TO_SHOW,
-                "totalPages": math.ceil(TOTAL_NEWS_TO_SHOW / limit)
+                "totalPages": math.ceil(TOTAL_NEWS_TO_SHOW / limit),
+                "nextCursor": next_cursor
             }
         }
-        return jsonify({"status": "success", "data": response_data})
+        with _feed_lock:
+            _feed_cache[cache_key] = {"etag": etag, "data": response_data}
+        return success_response(response_data, etag, FEED_MAX_AGE)
     except Exception as e:
         logger.error(f"WEB APP: Error fetching feed from Firestore: {e}", exc_info=True)
         return jsonify({"status": "error", "message": "Could not load feed from database."}), 500
     
 @app.route('/api/ask', methods=['POST'])
 def ask_question():
-    data = request.get_json()
-    question = data.get('question')
-    if not question:
+    try:
+        data = orjson.loads(request.get_data())
+    except orjson.JSONDecodeError:
+        return jsonify({"status": "error", "message": "Request body must be valid JSON."}), 400
+    question = data.get('question') if isinstance(data, dict) else None
+    if not isinstance(question, str) or not question.strip():
         return jsonify({"status": "error", "message": "No question provided."}), 400
     
-    if not analyzed_news_collection:
+    if not get_collection(ANALYZED_NEWS):
         return jsonify({"status": "error", "message": "Database connection not available for context."}), 500
 
     try:
-        # Context is still based on the latest 30 news items for relevance
-        query = analyzed_news_collection.order_by("published", direction=firestore.Query.DESCENDING).limit(50)
-        docs = query.stream()
-        news_context = [NewsItem(**doc.to_dict()) for doc in docs]
+        # Context is based on the latest 50 news items, shared with the main feed
+        docs = latest_news.get(LatestNewsCache.SIZE)
+        context_hash = AnswerCache.context_hash([doc.id for doc in docs])
+        answer_cache = get_answer_cache()
+        answer, embedding = answer_cache.get(question, context_hash)
+        # Clients opt into token streaming with ?stream=1 or an Accept: text/event-stream header
+        wants_stream = request.args.get('stream') == '1' or 'text/event-stream' in request.headers.get('Accept', '')
+        if answer is not None:
+            if wants_stream: return sse_response(iter([answer]))
+            return jsonify({"status": "success", "answer": answer})
+
+        news_context = [doc.to_dict() for doc in docs]
+        if wants_stream:
+            def stream_and_cache() -> Iterator[str]:
+                parts = []
+                for delta in get_ai_processor().stream_user_answer(question, news_context):
+                    parts.append(delta)
+                    yield delta
+                # A failed stream ends with the offline/error message; only complete answers are cached
+                if parts and parts[-1] not in (AIProcessor.OFFLINE_MESSAGE, AIProcessor.ERROR_MESSAGE):
+                    answer_cache.put(question, context_hash, "".join(parts), embedding)
+            return sse_response(stream_and_cache())
 
-        answer = ai_processor_for_qa.answer_user_question(question, news_context)
+        answer = get_ai_processor().answer_user_question(question, news_context)
+        if answer not in (AIProcessor.OFFLINE_MESSAGE, AIProcessor.ERROR_MESSAGE):
+            answer_cache.put(question, context_hash, answer, embedding)
         return jsonify({"status": "success", "answer": answer})
     except Exception as e:
         logger.error(f"WEB APP: Error in Q&A endpoint: {e}", exc_info=True)
@@ -311,4 +749,4 @@ def ask_question():
 
 if __name__ == '__main__':
     print("🚀 Starting FinanceFlow Web App [LOCAL DEVELOPMENT MODE]")
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
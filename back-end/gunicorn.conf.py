@@ -0,0 +1,37 @@
+# gunicorn.conf.py
+"""
+Gunicorn settings for the FinanceFlow web app.
+- The app is preloaded so import-time work (compiled regexes, the numba kernel, HTTP pools) is done
+  once in the master and shared copy-on-write with the forked workers. Firebase, yfinance and Groq
+  clients are created lazily inside each worker, which also keeps gRPC channels out of the fork.
+- gevent workers let outbound Firestore/yfinance/Groq calls yield instead of blocking a worker.
+"""
+
+# --- gevent must patch the stdlib before the preloaded app imports sockets/threads ---
+from gevent import monkey
+monkey.patch_all()
+
+try:
+    # Make Firestore's gRPC calls cooperate with the gevent hub
+    import grpc.experimental.gevent as grpc_gevent
+    grpc_gevent.init_gevent()
+except ImportError:
+    pass
+
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+preload_app = True
+# Each gevent worker already multiplexes worker_connections requests, and every worker holds its
+# own caches, so keep the count small; platforms set WEB_CONCURRENCY to match the container.
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'gevent'
+worker_connections = 500
+keepalive = 30
+
+
+def post_fork(server, worker):
+    # Start loading the Q&A embedding model as soon as the worker exists, not on the first /api/ask
+    from finance_news_backend import get_answer_cache
+    get_answer_cache()